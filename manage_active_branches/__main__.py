@@ -2,13 +2,22 @@
 
 import argparse
 import errno
+import functools
 import os
 import subprocess
 import sys
-from typing import TextIO, Iterable, List
+from typing import Iterator, List, Optional, Tuple, Union
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None  # type: ignore[assignment]
 
 ACTIVE_BRANCH_NAME = "active_branches_base"
 
+# keep the arguments we pass to any one git command well below ARG_MAX
+MAX_ARGV_BYTES = 128 * 1024
+
 
 class ManagerError(Exception):
     def __init__(self, message: str, code: int):
@@ -16,12 +25,81 @@ class ManagerError(Exception):
         self.code = code
 
 
+def _write_all(fd: int, data: Union[bytes, bytearray]) -> None:
+    """Write all of the given data to a file descriptor
+
+    os.write may write less than it was given (for instance if the disk fills
+    up part-way through), so keep going until it is all done.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _chunk_args(args: List[str]) -> Iterator[List[str]]:
+    """Split a list of arguments into chunks which each fit in MAX_ARGV_BYTES"""
+    chunk: List[str] = []
+    size = 0
+    for arg in args:
+        arg_size = len(os.fsencode(arg)) + 1
+        if chunk and size + arg_size > MAX_ARGV_BYTES:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(arg)
+        size += arg_size
+    if chunk:
+        yield chunk
+
+
 class Manager:
     def __init__(self, verbose: bool):
         self._verbose = verbose
-        self._git_dir = self._capture_cmd(
-            "git", "rev-parse", "--path-format=absolute", "--git-dir"
+
+    @functools.cached_property
+    def _git_dir(self) -> bytes:
+        return self._repo_info[0]
+
+    @functools.cached_property
+    def _head_branch(self) -> Optional[str]:
+        return self._repo_info[1]
+
+    @functools.cached_property
+    def _branches_file(self) -> bytes:
+        return os.path.join(self._git_dir, b"active-branches")
+
+    @functools.cached_property
+    def _merge_base_file(self) -> bytes:
+        return os.path.join(self._git_dir, b"active-branches-base")
+
+    @functools.cached_property
+    def _repo_info(self) -> Tuple[bytes, Optional[str]]:
+        """Find the git dir and the name of the current branch
+
+        Both are looked up with a single `git rev-parse`, to save an exec. The
+        current branch is None if HEAD does not yet point to a commit.
+        """
+        args = (
+            "git",
+            "rev-parse",
+            "--path-format=absolute",
+            "--git-dir",
+            "--abbrev-ref",
+            "--verify",
+            "-q",
+            "HEAD",
         )
+        try:
+            lines = self._capture_cmd(*args).splitlines()
+        except subprocess.CalledProcessError as e:
+            # on an unborn branch, rev-parse prints the git dir and then
+            # quietly fails to resolve HEAD. Anything else is a real error,
+            # which git will already have reported.
+            lines = e.stdout.splitlines()
+            if e.returncode != 1 or len(lines) != 1:
+                raise
+            return lines[0], None
+        return lines[0], lines[1].decode()
 
     def _capture_cmd(self, *args: str, **kwargs) -> bytes:
         """Run the given command, check its exitcode, and return its stdout"""
@@ -39,76 +117,195 @@ class Manager:
 
     def assert_wc_clean(self):
         """Check that the working copy is clean and throw an error if not"""
+        # --no-optional-locks stops us contending for the index lock with any
+        # other tooling that happens to be running.
         status = self._capture_cmd(
-            "git", "status", "--untracked-files=no", "--porcelain"
+            "git",
+            "--no-optional-locks",
+            "status",
+            "--untracked-files=no",
+            "--porcelain=v2",
+            "-z",
         )
 
         # if there is any output, the WC is dirty
-        if status != b"":
+        if len(status) != 0:
             raise ManagerError(f"Working copy has uncommitted changes", 1)
 
-    def _branches_file_name(self) -> bytes:
-        return os.path.join(self._git_dir, b"active-branches")
+    def _read_branches_file(self) -> bytes:
+        """Read the branches file, creating it if need be
 
-    def _open_or_create_branches_file(self) -> TextIO:
+        This uses raw file descriptors rather than python's buffered IO, which
+        for a file this small cuts it down to an open, a couple of reads and
+        a close.
+        """
+        fd = os.open(self._branches_file, os.O_RDONLY | os.O_CREAT, 0o644)
         try:
-            return open(self._branches_file_name(), "r")
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise
-            return open(self._branches_file_name(), "x+")
-
-    def _get_active_branches(self) -> Iterable[str]:
-        with self._open_or_create_branches_file() as f:
-            for line in f:
-                yield line.strip()
+            chunks = []
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        return b"".join(chunks)
+
+    def _replace_file(
+        self, path: bytes, contents: Union[bytes, bytearray], sync: bool = True
+    ) -> None:
+        """Atomically replace the contents of the given file
+
+        The new contents are written to a temporary file, bypassing python's
+        buffering, and (unless `sync` is False) synced to disk before the
+        temporary file is moved into place.
+        """
+        new_file = path + b".new"
+        fd = os.open(new_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _write_all(fd, contents)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(new_file, path)
+
+    def _get_active_branches(self) -> List[str]:
+        lines = self._read_branches_file().splitlines()
+        branches = (line.decode().strip() for line in lines)
+        return [branch for branch in branches if branch]
 
     def add_branch(self, branch_names: List[str]) -> int:
         if len(branch_names) == 0:
-            branch_names = [self._capture_cmd(
-                "git", "rev-parse", "--abbrev-ref", "HEAD"
-            ).decode()]
-
-        with open(self._branches_file_name(), "r+") as f:
-            # slurp in the file and check that the branch is not there already
-            for line in f:
-                line = line.strip()
-                if line in branch_names:
-                    print(f"Branch {line} already tracked", file=sys.stderr)
-                    break
-            else:
-                f.writelines(n + "\n" for n in branch_names)
-
+            if self._head_branch is None:
+                raise ManagerError("HEAD does not point to a commit", 1)
+            branch_names = [self._head_branch]
+
+        # slurp in the file and check that the branch is not there already
+        contents = self._read_branches_file()
+        wanted = set(branch_names)
+        for line in contents.splitlines():
+            branch = line.decode().strip()
+            if branch in wanted:
+                print(f"Branch {branch} already tracked", file=sys.stderr)
+                return 0
+
+        new_lines = "".join(n + "\n" for n in branch_names).encode()
+        # if the file was edited by hand, it may lack a trailing newline
+        if contents and not contents.endswith(b"\n"):
+            new_lines = b"\n" + new_lines
+
+        fd = os.open(
+            self._branches_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        try:
+            _write_all(fd, new_lines)
+        finally:
+            os.close(fd)
         return 0
 
     def remove_branch(self, branch_names: List[str]) -> int:
         unfound_branchnames = set(branch_names)
 
-        # open the existing file for reading
-        old_file = self._branches_file_name()
-        with self._open_or_create_branches_file() as old_fh:
-            # open a new file for writing
-            new_file = old_file + b".new"
-            with open(new_file, "w") as new_fh:
-                for line in old_fh.readlines():
-                    branch = line.strip()
-                    if branch in unfound_branchnames:
-                        unfound_branchnames.remove(branch)
-                    else:
-                        new_fh.write(line)
-
-        old_fh.close()
-        new_fh.close()
+        new_contents = bytearray()
+        for line in self._read_branches_file().splitlines():
+            branch = line.decode().strip()
+            if branch in unfound_branchnames:
+                unfound_branchnames.remove(branch)
+            else:
+                new_contents.extend(line)
+                new_contents.extend(b"\n")
 
+        # if any of the branches were not found, we leave the file untouched,
+        # so there is no need to write a new one.
         unfound = next(iter(unfound_branchnames), None)
-        if unfound is None:
-            # move the new file into place
-            os.replace(new_file, old_file)
-        else:
-            os.remove(new_file)
+        if unfound is not None:
             print(f"Branch {unfound} not previously tracked", file=sys.stderr)
+            return 0
+
+        self._replace_file(self._branches_file, new_contents)
         return 0
 
+    @functools.cached_property
+    def _pygit2_repo(self) -> "pygit2.Repository":
+        return pygit2.Repository(os.fsdecode(self._git_dir))
+
+    def _resolve_branches(self, branch_names: List[str]) -> List[str]:
+        """Find the commit ids at the tips of the given branches, using pygit2"""
+        commit_ids = []
+        for branch_name in branch_names:
+            # revparse_single raises KeyError for unknown names and
+            # ValueError for ambiguous or invalid ones; peel raises ValueError
+            # if the object isn't a commit.
+            try:
+                obj = self._pygit2_repo.revparse_single(branch_name)
+                commit = obj.peel(pygit2.Commit)
+            except (KeyError, ValueError):
+                raise ManagerError(
+                    f"Unknown or ambiguous branch {branch_name}", 1
+                )
+            commit_ids.append(str(commit.id))
+        return commit_ids
+
+    def _merge_base(self, commit_ids: List[str]) -> str:
+        """Find the common base of the given commits with pygit2
+
+        This is the equivalent of `git merge-base --octopus`.
+        """
+        # libgit2 insists on at least two commits
+        if len(commit_ids) == 1:
+            return commit_ids[0]
+        base = self._pygit2_repo.merge_base_octopus(
+            [pygit2.Oid(hex=c) for c in commit_ids]
+        )
+        if base is None:
+            raise ManagerError("Active branches have no common ancestor", 1)
+        return str(base)
+
+    def _find_merge_base(self, branch_names: List[str]) -> str:
+        """Find the common base of the given branches
+
+        With pygit2, the branches are resolved in-process, so the result can
+        cheaply be remembered in the git dir alongside the branch tips it was
+        computed from, and the graph walk skipped when none of the branches
+        have moved since the last update. Without it, checking such a cache
+        would cost as much as the `git merge-base` it is meant to save.
+        """
+        if pygit2 is None:
+            # `merge-base --octopus` can't read its arguments from stdin, so if
+            # there are too many branches for one command line, fold over them
+            # in chunks, carrying the base of each chunk into the next.
+            merge_base: Optional[str] = None
+            for chunk in _chunk_args(branch_names):
+                if merge_base is not None:
+                    chunk.insert(0, merge_base)
+                merge_base = self._capture_cmd(
+                    "git", "merge-base", "--octopus", *chunk
+                ).decode()
+            assert merge_base is not None
+            return merge_base
+
+        commit_ids = self._resolve_branches(branch_names)
+        try:
+            with open(self._merge_base_file, "r") as f:
+                cached = f.read().splitlines()
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            cached = []
+        if cached and cached[1:] == commit_ids:
+            return cached[0]
+
+        # the cache is disposable (a torn write just makes for a cache miss),
+        # so don't bother syncing it.
+        merge_base = self._merge_base(commit_ids)
+        self._replace_file(
+            self._merge_base_file,
+            "".join(c + "\n" for c in [merge_base, *commit_ids]).encode(),
+            sync=False,
+        )
+        return merge_base
+
     def ls_branches(self) -> int:
         for branch in self._get_active_branches():
             print(branch)
@@ -119,20 +316,47 @@ class Manager:
         self.assert_wc_clean()
 
         active_branches = list(self._get_active_branches())
+        if len(active_branches) == 0:
+            raise ManagerError("No active branches", 1)
 
         if not continue_merge:
             # create the branch based on the common base of the branches for this repo
-            merge_base = self._capture_cmd(
-                "git", "merge-base", "--octopus", *active_branches
-            ).decode()
+            merge_base = self._find_merge_base(active_branches)
             self._run_cmd("git", "checkout", "-B", ACTIVE_BRANCH_NAME, merge_base)
 
+            # if there is more than one branch, try merging them all at once
+            # with an octopus merge. Octopus can't leave conflicts for the user
+            # to resolve, so if that fails, back it out and fall back to one
+            # branch at a time. Likewise if there are too many branches to fit
+            # on one command line.
+            argv_chunks = list(_chunk_args(active_branches))
+            if len(active_branches) > 1 and len(argv_chunks) == 1:
+                print("Merging all active branches", file=sys.stderr)
+                try:
+                    self._run_cmd("git", "merge", "--no-edit", *active_branches)
+                    return 0
+                except subprocess.CalledProcessError as e:
+                    # git merge exits with 1 or 2 if the merge itself failed;
+                    # anything else is a more fundamental problem.
+                    if e.returncode not in (1, 2):
+                        raise
+                print(
+                    "Octopus merge failed; merging branches one at a time",
+                    file=sys.stderr,
+                )
+                # drop any rerere preimages recorded by the failed attempt
+                self._run_cmd("git", "rerere", "clear")
+                self._run_cmd("git", "reset", "--merge")
+                print("\n-----\n")
+
         # merge each of the active branches into it in turn.
         for branch_name in active_branches:
             print(f"Merging {branch_name}", file=sys.stderr)
             self._run_cmd("git", "merge", "--no-edit", branch_name)
             print("\n-----\n")
 
+        return 0
+
 
 def main() -> int:
     parser = argparse.ArgumentParser()